@@ -0,0 +1,76 @@
+"""Numba kernel for remapping frames to a palette."""
+
+import numba
+import numpy as onp
+
+
+def new_cache() -> onp.ndarray:
+    """Returns an empty cache of palette indices for all 24-bit colors."""
+    return onp.full(1 << 24, -1, dtype=onp.int16)
+
+
+def remap(
+    frame: onp.ndarray,
+    palette: onp.ndarray,
+    cache: onp.ndarray,
+    out: onp.ndarray,
+) -> None:
+    """Writes the index of the nearest palette color for each pixel to `out`.
+
+    Frames rendered by matplotlib typically contain few distinct colors, and so
+    the nearest palette index for each color is stored in `cache` and reused.
+
+    Args:
+        frame: The `(height, width, 3)` uint8 RGB frame.
+        palette: The `(num_colors, 3)` uint8 RGB palette.
+        cache: Array from `new_cache`, which is updated in place. It may be shared
+            by calls that use the same palette.
+        out: The `(height, width)` uint8 array to which indices are written.
+    """
+    # The palette channels are stored as separate contiguous int32 arrays, so
+    # that the inner search loop reads them with unit stride and no conversion.
+    palette = onp.ascontiguousarray(palette.T, dtype=onp.int32)
+    frame = onp.ascontiguousarray(frame)
+    _remap(frame, palette[0], palette[1], palette[2], cache, out)
+
+
+# The kernel is compiled eagerly for its single signature, and the compiled code is
+# cached on disk, so that only the first use after installation pays for the JIT.
+@numba.njit(
+    "void(u1[:, :, ::1], i4[::1], i4[::1], i4[::1], i2[::1], u1[:, ::1])",
+    parallel=True,
+    fastmath=True,
+    cache=True,
+)
+def _remap(
+    frame: onp.ndarray,
+    palette_r: onp.ndarray,
+    palette_g: onp.ndarray,
+    palette_b: onp.ndarray,
+    cache: onp.ndarray,
+    out: onp.ndarray,
+) -> None:
+    """Kernel for `remap`, taking each palette channel as a separate array."""
+    height, width = out.shape
+    num_colors = palette_r.shape[0]
+    for y in numba.prange(height):
+        for x in range(width):
+            r = numba.int32(frame[y, x, 0])
+            g = numba.int32(frame[y, x, 1])
+            b = numba.int32(frame[y, x, 2])
+            key = (r << 16) | (g << 8) | b
+            best_index = cache[key]
+            if best_index < 0:
+                # The distance and palette index are packed into a single integer,
+                # so that the search is a branchless min-reduction that can be
+                # vectorized, similar to the SIMD sum-of-absolute-differences.
+                best = numba.int32(0x7FFFFFFF)
+                for c in range(num_colors):
+                    dr = r - palette_r[c]
+                    dg = g - palette_g[c]
+                    db = b - palette_b[c]
+                    best = min(best, ((dr * dr + dg * dg + db * db) << 8) | c)
+                best_index = best & 0xFF
+                # Concurrent writes for the same color store the same value.
+                cache[key] = best_index
+            out[y, x] = best_index
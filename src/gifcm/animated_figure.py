@@ -1,12 +1,42 @@
-"""Module for creating animations from matplotlib figures."""
+"""Module for creating animations from matplotlib figures.
 
-import io
+Palette computation with the `"pil"` backend, as well as remapping when numba is
+not installed, run in Pillow. These benefit from the AVX2-vectorized Pillow-SIMD
+fork, a drop-in replacement for Pillow which can be installed manually in its
+place.
+"""
+
+import functools
+import hashlib
+import os
 import types
-from typing import List, Sequence, Tuple
+from concurrent import futures
+from typing import Any, List, Optional, Sequence, Tuple, Union
 
 import matplotlib.figure as mpl_figure
 import numpy as onp
-from PIL import Image
+from matplotlib.backends import backend_agg
+from PIL import GifImagePlugin, Image
+
+_BACKENDS = ("pil", "imagequant")
+_PALETTE_MODES = ("adaptive", "fixed")
+_DITHER_MODES = ("none", "bluenoise")
+
+# The fixed palette is the 6x6x6 web-safe color cube, with channel values that are
+# multiples of 51. `_CUBE_LEVELS` maps a channel value to the nearest cube level.
+_CUBE_STEP = 51
+_CUBE_LEVELS = ((onp.arange(256) + _CUBE_STEP // 2) // _CUBE_STEP).astype(onp.uint8)
+_CUBE_PALETTE = [_CUBE_STEP * c for rgb in onp.ndindex(6, 6, 6) for c in rgb]
+
+# The amplitude of blue noise dithering with an adaptive palette. The adaptive
+# palette is denser than the fixed palette, and so a smaller amplitude suffices.
+_ADAPTIVE_DITHER_AMPLITUDE = 16
+
+# The approximate number of pixels sampled from the frames to compute the palette.
+_PALETTE_SAMPLE_SIZE = 200_000
+
+# The approximate size in bytes of each chunk in which captured frames are stored.
+_CHUNK_BYTES = 64 * 2**20
 
 
 class AnimatedFigure:
@@ -22,17 +52,208 @@ class AnimatedFigure:
 
         animated_figure.save_gif('my_animation.gif')
 
+    When `gif_path` is specified, frames are instead written to the gif as they
+    are created, so that only a single frame is held in memory. In this case the
+    palette is computed from the first frame (or is the fixed web-safe palette),
+    and the gif is completed by calling `close` rather than `save_gif`. The
+    animated figure can also be used as a context manager, which calls `close`
+    on exit:
+
+        with AnimatedFigure(plt.figure(), gif_path='my_animation.gif') as anim:
+            for i in range(10):
+                with anim.frame():
+                    plt.plot(i, i, 'o')
+
+    Each frame is the full figure canvas, rendered at the figure's dpi and with
+    its facecolor; unlike `savefig`, it is not cropped to a tight bounding box and
+    does not use the `savefig.*` rcParams. Margins can instead be reduced with
+    `tight_layout=True`, which keeps the frame size fixed.
+
     Attributes:
         figure: The matplotlib figure used to create frames of the animation.
-        frames: List of arrays containing the rasterized frames.
     """
 
-    def __init__(self, figure: mpl_figure.Figure) -> None:
+    def __init__(
+        self,
+        figure: mpl_figure.Figure,
+        gif_path: Optional[str] = None,
+        duration: Optional[int] = None,
+        loop: Optional[int] = None,
+        palette_mode: Optional[str] = None,
+        blit: bool = False,
+        tight_layout: bool = False,
+    ) -> None:
+        """Initializes the animated figure.
+
+        Args:
+            figure: The matplotlib figure used to create frames of the animation.
+            gif_path: Optional path of a gif to which frames are streamed.
+            duration: The duration of each streamed frame, in milliseconds.
+                Defaults to `100`. May only be specified with `gif_path`.
+            loop: Determines whether or how many times the streamed animation
+                should loop. A value of `0`, the default, means the animation
+                should loop infinitely. May only be specified with `gif_path`.
+            palette_mode: The palette mode of the streamed gif, either
+                `"adaptive"` (the default) or `"fixed"`. May only be specified
+                with `gif_path`.
+            blit: If `True`, the figure as drawn at initialization is used as a
+                static background; it is restored at the start of each frame, and
+                only artists drawn with e.g. `ax.draw_artist` within the frame are
+                added to it. The figure is never cleared or fully redrawn, and so
+                the `clear_figure` argument of `frame` is ignored.
+            tight_layout: If `True`, the tight layout engine is set on the figure,
+                so that subplot margins are reduced each time a frame is drawn.
+        """
+        if palette_mode is not None and palette_mode not in _PALETTE_MODES:
+            raise ValueError(
+                f"`palette_mode` must be one of {_PALETTE_MODES}, but got "
+                f"{palette_mode}."
+            )
+        if duration is not None and duration <= 0:
+            raise ValueError(f"`duration` must be positive, but got {duration}.")
+        if loop is not None and loop < 0:
+            raise ValueError(f"`loop` must be nonnegative, but got {loop}.")
+        stream_options = [
+            ("duration", duration),
+            ("loop", loop),
+            ("palette_mode", palette_mode),
+        ]
+        specified = [name for name, value in stream_options if value is not None]
+        if gif_path is None and specified:
+            raise ValueError(
+                f"{specified} apply only to a streamed gif and require `gif_path`; "
+                f"otherwise, pass them to `save_gif`."
+            )
+
         self.figure = figure
-        self.frames: List[onp.ndarray] = []
+        if tight_layout:
+            figure.set_layout_engine("tight")
+        self._chunks: List[onp.ndarray] = []
+        self._num_frames = 0
+        self._num_reserved = 0
+        self._frame_counts: List[int] = []
+        self._last_frame_hash: Optional[bytes] = None
+        self._gif_stream: Optional[_GifStream] = None
+        if gif_path is not None:
+            self._gif_stream = _GifStream(
+                gif_path=gif_path,
+                duration=100 if duration is None else duration,
+                loop=0 if loop is None else loop,
+                palette_mode="adaptive" if palette_mode is None else palette_mode,
+            )
+        self._background: Optional[Any] = None
+        if blit:
+            canvas = _agg_canvas(figure)
+            canvas.draw()
+            self._background = canvas.copy_from_bbox(figure.bbox)
+
+    @property
+    def frames(self) -> onp.ndarray:
+        """Array of rasterized frames, with shape `(num_frames, height, width, 3)`.
+
+        Consecutive identical frames are stored only once. Frames are captured in
+        chunks, which are concatenated into a single array when this property is
+        accessed. Note that in earlier versions `frames` was a list; frames are
+        now added only with `frame`, and cannot be appended to `frames`.
+        """
+        if not self._chunks:
+            return onp.zeros((0, 0, 0, 3), dtype=onp.uint8)
+        if len(self._chunks) > 1:
+            frames = onp.concatenate(self._frame_chunks())
+            self._chunks = [frames]
+        return self._chunks[0][: self._num_frames]
+
+    def reserve(self, num_frames: int) -> None:
+        """Preallocates storage for `num_frames` frames.
+
+        Frames are stored in chunks of roughly 64 MB, so that storage exceeds the
+        frame data by at most one chunk and is never reallocated while frames are
+        captured. The chunks are concatenated when `frames` is accessed, which
+        briefly holds the frame data twice. Reserving storage for the expected
+        number of frames allocates it as a single chunk, avoiding the
+        concatenation.
+
+        Storage is allocated when the next chunk is needed, i.e. with the first
+        frame or when the current chunk is full.
+
+        Args:
+            num_frames: The number of frames for which storage is reserved.
+        """
+        self._num_reserved = num_frames
+
+    def _append_frame(self, frame: onp.ndarray) -> None:
+        """Copies `frame` into the frame buffer, or writes it to the gif stream.
+
+        A frame identical to the previous frame is not stored; rather, the
+        previous frame is displayed for longer.
+
+        Args:
+            frame: The rasterized RGBA frame. The alpha channel is discarded, since
+                gifs do not support partial transparency.
+        """
+        # The shape is hashed as well, so that a frame with different shape but
+        # identical bytes is not merged and is instead rejected below.
+        frame_hash = hashlib.blake2b(str(frame.shape).encode(), digest_size=8)
+        frame_hash.update(frame.data)
+        if frame_hash.digest() == self._last_frame_hash:
+            self._frame_counts[-1] += 1
+            if self._gif_stream is not None:
+                self._gif_stream.repeat_last()
+            return
+        # The frame is validated and stored before the frame counts are updated,
+        # so that they remain consistent when a frame is rejected.
+        frame = frame[..., :3]
+        if self._gif_stream is not None:
+            self._gif_stream.write(frame)
+        else:
+            self._store_frame(frame)
+        self._last_frame_hash = frame_hash.digest()
+        self._frame_counts.append(1)
+
+    def _store_frame(self, frame: onp.ndarray) -> None:
+        """Copies `frame` into the last chunk, adding a new chunk if necessary."""
+        if self._chunks and frame.shape != self._chunks[0].shape[1:]:
+            raise ValueError(
+                f"All frames must have the same shape, but got shape {frame.shape} "
+                f"after frames with shape {self._chunks[0].shape[1:]}."
+            )
+        capacity = self._capacity()
+        if self._num_frames == capacity:
+            size = max(
+                self._num_reserved - self._num_frames,
+                _CHUNK_BYTES // frame.nbytes,
+                1,
+            )
+            self._chunks.append(onp.empty((size,) + frame.shape, dtype=frame.dtype))
+            capacity += size
+        last_chunk = self._chunks[-1]
+        last_chunk[self._num_frames - capacity + len(last_chunk)] = frame
+        self._num_frames += 1
+
+    def _capacity(self) -> int:
+        """Returns the number of frames that fit in the allocated chunks."""
+        return sum(len(chunk) for chunk in self._chunks)
+
+    def _frame_chunks(self) -> List[onp.ndarray]:
+        """Returns the chunks, trimmed to the captured frames."""
+        chunks = []
+        num_remaining = self._num_frames
+        for chunk in self._chunks:
+            chunks.append(chunk[:num_remaining])
+            num_remaining -= len(chunks[-1])
+        return chunks
 
     def frame(self, clear_figure: bool = True) -> "Frame":
-        """Returns a new `Frame` context manager."""
+        """Returns a new `Frame` context manager.
+
+        Args:
+            clear_figure: Whether the figure is cleared at the start of the frame.
+                This has no effect when blitting, since the background is then
+                restored instead.
+
+        Returns:
+            The `Frame` context manager.
+        """
         return Frame(animated_figure=self, clear_figure=clear_figure)
 
     def save_gif(
@@ -40,6 +261,10 @@ class AnimatedFigure:
         gif_path: str,
         duration: int = 100,
         loop: int = 0,
+        backend: str = "pil",
+        palette_mode: str = "adaptive",
+        dither: str = "none",
+        palette: Optional[Image.Image] = None,
     ) -> None:
         """Saves the frames to an animated gif.
 
@@ -48,14 +273,96 @@ class AnimatedFigure:
             duration: The duration of each frame, in milliseconds.
             loop: Determines whether or how many times the animation should loop.
                 A value of `0` means the animation should loop infinitely.
+            backend: The quantization backend used to compute the palette, either
+                `"pil"` or `"imagequant"`. The latter requires the optional
+                `imagequant` package, which wraps libimagequant. Only the default
+                is allowed when no palette is computed, i.e. with `palette` or
+                with the fixed palette mode.
+            palette_mode: Either `"adaptive"`, in which case the palette is computed
+                from the frames, or `"fixed"`, in which case the 216-color web-safe
+                palette is used. The fixed palette is much faster, but may yield
+                visible banding for smooth color gradients.
+            dither: Either `"none"` or `"bluenoise"`. Blue noise dithering reduces
+                banding, particularly with the fixed palette.
+            palette: Optional paletted (mode `"P"`) image whose palette is used,
+                e.g. an image with the colors of a known colormap. If specified,
+                no palette is computed from the frames. It cannot be used with the
+                fixed palette mode.
         """
+        if self._gif_stream is not None:
+            raise ValueError(
+                "Frames are streamed to the gif specified by `gif_path`; use "
+                "`close` to complete it."
+            )
         _save_frames_to_gif(
             frames=self.frames,
             gif_path=gif_path,
-            duration=duration,
+            duration=[duration * count for count in self._frame_counts],
             loop=loop,
+            backend=backend,
+            palette_mode=palette_mode,
+            dither=dither,
+            palette=palette,
+        )
+
+    def save_video(self, video_path: str, fps: float = 10) -> None:
+        """Saves the frames to an H.264 video, e.g. an mp4.
+
+        Video encoding requires no palette computation, and for long animations
+        it is typically much faster than gif encoding and yields a much smaller
+        file. This requires the optional `imageio` and `imageio-ffmpeg` packages.
+
+        If numba is installed and uses its TBB threading layer, the interpreter may
+        hang at exit after frames have been remapped by the numba kernel and a
+        video has been saved. Selecting another layer, e.g. with the environment
+        variable `NUMBA_THREADING_LAYER=workqueue`, avoids this.
+
+        Args:
+            video_path: The path where the video will be saved.
+            fps: The number of frames per second.
+        """
+        if self._gif_stream is not None:
+            raise ValueError(
+                "Frames are streamed to the gif specified by `gif_path`, and so "
+                "they are not available to save as a video."
+            )
+        _save_frames_to_video(
+            frames=self.frames,
+            frame_counts=self._frame_counts,
+            video_path=video_path,
+            fps=fps,
         )
 
+    def close(self) -> None:
+        """Completes the gif to which frames are streamed.
+
+        Calling `close` more than once has no further effect.
+        """
+        if self._gif_stream is None:
+            raise ValueError("`close` requires `gif_path` to have been specified.")
+        self._gif_stream.close()
+
+    def __enter__(self) -> "AnimatedFigure":
+        return self
+
+    def __exit__(
+        self,
+        exception_type: type[BaseException] | None,
+        exception_value: BaseException | None,
+        traceback: types.TracebackType | None,
+    ) -> None:
+        if self._gif_stream is None:
+            return
+        if exception_type is None:
+            self._gif_stream.close()
+            return
+        # The file is closed without masking the exception raised during capture,
+        # e.g. when it is raised before any frame has been written.
+        try:
+            self._gif_stream.close()
+        except ValueError:
+            pass
+
 
 class Frame:
     """Enables creation of a single frame in a sequence of frames."""
@@ -69,8 +376,12 @@ class Frame:
         self.clear_figure = clear_figure
 
     def __enter__(self) -> "Frame":
-        if self.clear_figure:
-            self.animated_figure.figure.clf()
+        figure = self.animated_figure.figure
+        background = self.animated_figure._background
+        if background is not None:
+            _agg_canvas(figure).restore_region(background)
+        elif self.clear_figure:
+            figure.clf()
         return self
 
     def __exit__(
@@ -79,65 +390,527 @@ class Frame:
         exception_value: BaseException | None,
         traceback: types.TracebackType,
     ) -> None:
-        frame = _save_figure_to_array(self.animated_figure.figure)
-        self.animated_figure.frames.append(frame)
+        figure = self.animated_figure.figure
+        if self.animated_figure._background is not None:
+            figure.canvas.blit(figure.bbox)
+            frame = _render_figure(figure, draw=False)
+        else:
+            frame = _render_figure(figure)
+        self.animated_figure._append_frame(frame)
+
+
+class _GifStream:
+    """Writes frames to a gif image as they are created."""
+
+    def __init__(
+        self,
+        gif_path: str,
+        duration: int,
+        loop: int,
+        palette_mode: str,
+    ) -> None:
+        if not gif_path.endswith(".gif"):
+            raise ValueError(
+                f"Valid `gif_path` must end in '.gif', but got {gif_path}."
+            )
+        self.duration = duration
+        self.loop = loop
+        self.palette_mode = palette_mode
+        # The file stays open across calls to `write`, and is closed by `close`.
+        self._file = open(gif_path, "wb")  # noqa: SIM115
+        self._palette_image: Optional[Image.Image] = None
+        self._pending_image: Optional[Image.Image] = None
+        self._pending_count = 0
+        self._remap_cache: Optional[onp.ndarray] = None
+
+    def write(self, frame: onp.ndarray) -> None:
+        """Quantizes `frame` and writes it to the gif.
+
+        The frame is held until the next call to `write` or `close`, since its
+        duration is extended by any calls to `repeat_last`.
+
+        Args:
+            frame: The rasterized frame.
+        """
+        if self._palette_image is not None:
+            width, height = self._palette_image.size
+            if frame.shape[:2] != (height, width):
+                raise ValueError(
+                    f"All frames must have the same shape, but got shape "
+                    f"{frame.shape} after frames with shape {(height, width, 3)}."
+                )
+        self._write_pending()
+        if self._palette_image is None:
+            self._palette_image = self._init_palette_image(frame)
+            header, _ = GifImagePlugin.getheader(
+                self._palette_image,
+                info={"duration": self.duration, "loop": self.loop},
+            )
+            self._file.writelines(header)
+            if self.palette_mode != "fixed":
+                # The palette is fixed for the whole stream, and so the colors
+                # remapped in earlier frames are cached across frames.
+                self._remap_cache = _new_remap_cache()
+        if self.palette_mode == "fixed":
+            quantized, _ = _quantize_frames_fixed(frame[onp.newaxis])
+            indices = quantized[0]
+        else:
+            indices = _remap_frames(
+                frame[onp.newaxis], self._palette_image, cache=self._remap_cache
+            )[0]
+        self._pending_image = Image.fromarray(indices)
+        self._pending_count = 1
+
+    def repeat_last(self) -> None:
+        """Extends the duration of the most recently written frame."""
+        self._pending_count += 1
+
+    def close(self) -> None:
+        """Writes the gif trailer and closes the file, if it is still open."""
+        if self._file.closed:
+            return
+        try:
+            if self._palette_image is None:
+                raise ValueError("At least one frame is required.")
+            self._write_pending()
+            self._file.write(b";")
+        finally:
+            self._file.close()
 
+    def _write_pending(self) -> None:
+        """Writes the pending frame, if any, to the gif."""
+        if self._pending_image is None:
+            return
+        duration = self.duration * self._pending_count
+        data = GifImagePlugin.getdata(self._pending_image, duration=duration)
+        self._file.writelines(data)
+        self._pending_image = None
 
-def _save_figure_to_array(figure: mpl_figure.Figure) -> onp.ndarray:
-    """Saves a figure to a numpy array."""
-    with io.BytesIO() as bytes_io:
-        figure.savefig(bytes_io, bbox_inches="tight", pad_inches=0.0, format="png")
-        bytes_io.seek(0)
-        return onp.asarray(Image.open(bytes_io, mode="r"))
+    def _init_palette_image(self, frame: onp.ndarray) -> Image.Image:
+        """Returns a paletted image having the size of `frame` and the palette."""
+        height, width = frame.shape[:2]
+        palette_image = Image.new("P", (width, height))
+        if self.palette_mode == "fixed":
+            palette = _CUBE_PALETTE
+        else:
+            sample = _sample_pixels(frame[onp.newaxis])
+            palette = _get_palette(_compute_palette_image(sample, backend="pil"))
+        palette_image.putpalette(palette)
+        return palette_image
+
+
+def _render_figure(figure: mpl_figure.Figure, draw: bool = True) -> onp.ndarray:
+    """Optionally draws the figure, and returns a view of the canvas RGBA buffer."""
+    canvas = _agg_canvas(figure)
+    if draw:
+        canvas.draw()
+    return onp.asarray(canvas.buffer_rgba())
+
+
+def _agg_canvas(figure: mpl_figure.Figure) -> Any:
+    """Returns the Agg canvas of `figure`, attaching one if necessary.
+
+    Frames are read from the RGBA buffer of an Agg canvas. Figures created with
+    a vector backend such as svg or pdf have a canvas without that buffer, and
+    so an Agg canvas replaces it.
+    """
+    if isinstance(figure.canvas, backend_agg.FigureCanvasAgg):
+        return figure.canvas
+    return backend_agg.FigureCanvasAgg(figure)
+
+
+def _save_frames_to_video(
+    frames: onp.ndarray,
+    frame_counts: Sequence[int],
+    video_path: str,
+    fps: float,
+) -> None:
+    """Saves frames to an H.264 video.
+
+    Args:
+        frames: The rank-4 array of frames to be converted to a video.
+        frame_counts: The number of times each frame is repeated.
+        video_path: The path where the video will be saved.
+        fps: The number of frames per second.
+    """
+    try:
+        import imageio
+    except ImportError as e:
+        raise ImportError(
+            "Saving videos requires the `imageio` and `imageio-ffmpeg` packages, "
+            "which can be installed with `pip install gifcm[video]`."
+        ) from e
+    if len(frames) == 0:
+        raise ValueError("At least one frame is required.")
+
+    # H.264 with 4:2:0 chroma subsampling requires even frame dimensions. Frames
+    # are padded by replicating their last row or column, rather than rescaled to
+    # a multiple of the default macro block size of 16.
+    height, width = frames.shape[1:3]
+    pad_width = ((0, height % 2), (0, width % 2), (0, 0))
+    # The writer is not bound with `as`, since `__enter__` is annotated to return
+    # the base class, which lacks `append_data`.
+    writer = imageio.get_writer(
+        video_path, fps=fps, codec="libx264", quality=8, macro_block_size=2
+    )
+    with writer:
+        for frame, count in zip(frames, frame_counts):
+            if height % 2 or width % 2:
+                frame = onp.pad(frame, pad_width, mode="edge")
+            for _ in range(count):
+                writer.append_data(frame)
 
 
 def _save_frames_to_gif(
-    frames: Sequence[onp.ndarray],
+    frames: onp.ndarray,
     gif_path: str,
-    duration: int,
+    duration: Union[int, Sequence[int]],
     loop: int,
+    backend: str = "pil",
+    palette_mode: str = "adaptive",
+    dither: str = "none",
+    palette: Optional[Image.Image] = None,
 ) -> None:
     """Saves frames to a gif image.
 
     Args:
-        frames: The frames to be converted to a gif image.
+        frames: The rank-4 array of frames to be converted to a gif image.
         gif_path: The path where the image will be saved.
-        duration: The duration of each frame, in milliseconds.
+        duration: The duration of each frame, in milliseconds, either a single
+            value for all frames or a sequence with one value per frame.
         loop: Determines whether or how many times the animation should loop.
             A value of `0` means the animation should loop infinitely.
+        backend: The quantization backend, either `"pil"` or `"imagequant"`.
+        palette_mode: The palette mode, either `"adaptive"` or `"fixed"`.
+        dither: The dithering mode, either `"none"` or `"bluenoise"`.
+        palette: Optional paletted image whose palette is used.
     """
     if len(frames) == 0:
         raise ValueError("At least one frame is required.")
-    if frames[0].ndim != 3:
-        raise ValueError(
-            f"Frames must be rank-3, but first frame had shape {frames[0].shape}"
-        )
-    if not all(frame.shape == frames[0].shape for frame in frames):
+    # Frames are stacked in a single array, and so they all have the same shape.
+    if frames.ndim != 4:
         raise ValueError(
-            f"All frames must have the same shape, but got shapes "
-            f"{[frame.shape for frame in frames]}."
+            f"Frames must be rank-3, but got frames with shape {frames.shape[1:]}"
         )
     if not gif_path.endswith(".gif"):
         raise ValueError(f"Valid `gif_path` must end in '.gif', but got {gif_path}.")
+    if backend not in _BACKENDS:
+        raise ValueError(f"`backend` must be one of {_BACKENDS}, but got {backend}.")
+    if palette_mode not in _PALETTE_MODES:
+        raise ValueError(
+            f"`palette_mode` must be one of {_PALETTE_MODES}, but got {palette_mode}."
+        )
+    if dither not in _DITHER_MODES:
+        raise ValueError(f"`dither` must be one of {_DITHER_MODES}, but got {dither}.")
+    if palette is not None and palette.mode != "P":
+        raise ValueError(
+            f"`palette` must be a paletted image with mode 'P', but got mode "
+            f"{palette.mode}."
+        )
+    if palette is not None and palette_mode == "fixed":
+        raise ValueError("`palette` cannot be specified with `palette_mode='fixed'`.")
+    if backend != "pil" and (palette is not None or palette_mode == "fixed"):
+        raise ValueError(
+            "`backend` is only used to compute an adaptive palette, and cannot be "
+            "specified with `palette` or with `palette_mode='fixed'`."
+        )
 
-    frames, palette = _quantize_frames(frames)
-    image, *images = (Image.fromarray(frame) for frame in frames)
+    if palette_mode == "fixed":
+        if dither == "bluenoise":
+            frames = _dither_bluenoise(
+                frames, amplitude=_CUBE_STEP, palette=_CUBE_PALETTE
+            )
+        quantized_frames, palette_colors = _quantize_frames_fixed(frames)
+    else:
+        quantized_frames, palette_colors = _quantize_frames(
+            frames, backend=backend, dither=dither, palette_image=palette
+        )
+    # Images are created lazily from the quantized frames. Note that Pillow's gif
+    # writer copies each appended image and holds the copies until the file is
+    # written, and so this does not reduce peak memory.
+    image = Image.fromarray(quantized_frames[0])
+    images = (Image.fromarray(frame) for frame in quantized_frames[1:])
     image.save(
         gif_path,
         save_all=True,
         append_images=images,
         duration=duration,
         loop=loop,
-        palette=palette,
+        palette=palette_colors,
     )
 
 
 def _quantize_frames(
-    frames: Sequence[onp.ndarray],
-) -> Tuple[List[onp.ndarray], List[int]]:
-    """Returns quantized frames and the corresponding palette."""
-    merged = Image.fromarray(onp.concatenate(frames))
-    quantized = merged.quantize(colors=256, dither=0)
-    quantized_frames = onp.split(onp.asarray(quantized), len(frames))
-    palette: List[int] = quantized.getpalette()
-    return list(quantized_frames), palette
+    frames: onp.ndarray,
+    backend: str = "pil",
+    dither: str = "none",
+    palette_image: Optional[Image.Image] = None,
+) -> Tuple[onp.ndarray, List[int]]:
+    """Returns quantized frames and the corresponding palette.
+
+    Args:
+        frames: The rank-4 array of frames to be quantized.
+        backend: The backend used to compute the palette.
+        dither: The dithering mode, either `"none"` or `"bluenoise"`.
+        palette_image: Optional paletted image whose palette is used. If `None`,
+            the palette is computed from the frames.
+
+    Returns:
+        The quantized frames and the palette.
+    """
+    if palette_image is None:
+        palette_image = _compute_palette_image(_sample_pixels(frames), backend=backend)
+    # The palette image is shared by all frames, and so it is loaded only once.
+    palette_image.load()
+    palette = _get_palette(palette_image)
+    if dither == "bluenoise":
+        frames = _dither_bluenoise(
+            frames, amplitude=_ADAPTIVE_DITHER_AMPLITUDE, palette=palette
+        )
+    quantized_frames = _remap_frames(frames, palette_image)
+    return quantized_frames, palette
+
+
+def _get_palette(palette_image: Image.Image) -> List[int]:
+    """Returns the RGB palette of a paletted image."""
+    palette: Optional[List[int]] = palette_image.getpalette()
+    if palette is None:
+        raise ValueError("The image does not have a palette.")
+    return palette
+
+
+def _quantize_frames_fixed(
+    frames: onp.ndarray,
+) -> Tuple[onp.ndarray, List[int]]:
+    """Returns frames quantized to the fixed 6x6x6 color cube, and its palette."""
+    levels = _CUBE_LEVELS[frames]
+    quantized_frames = levels[..., 0] * 36 + levels[..., 1] * 6 + levels[..., 2]
+    return quantized_frames, _CUBE_PALETTE
+
+
+def _dither_bluenoise(
+    frames: onp.ndarray,
+    amplitude: float,
+    palette: Optional[Sequence[int]] = None,
+) -> onp.ndarray:
+    """Returns `frames` with a blue noise offset added to each pixel.
+
+    Unlike error diffusion, the offset for each pixel is independent of all other
+    pixels, and so it is applied with vectorized operations.
+
+    Pixels whose color is exactly a color of `palette` are not offset, so that
+    flat regions of such a color, e.g. a white background, are not speckled with
+    neighboring palette colors. Flat regions of other colors are dithered.
+
+    Args:
+        frames: The rank-4 array of frames to be dithered.
+        amplitude: The peak-to-peak amplitude of the offset.
+        palette: Optional flat RGB palette whose colors are not offset.
+
+    Returns:
+        The dithered frames.
+    """
+    height, width = frames.shape[1:3]
+    tile = _blue_noise_tile()
+    reps = (-(-height // tile.shape[0]), -(-width // tile.shape[1]))
+    noise = onp.tile(tile, reps)[:height, :width]
+    offset = onp.round((noise - 0.5) * amplitude).astype(onp.int16)
+    in_palette = None
+    if palette is not None:
+        in_palette = onp.zeros(1 << 24, dtype=bool)
+        in_palette[_pack_colors(onp.asarray(palette, onp.uint8).reshape(-1, 3))] = True
+    dithered = onp.empty_like(frames)
+    for frame, dithered_frame in zip(frames, dithered):
+        dithered_frame[...] = onp.clip(frame + offset[..., onp.newaxis], 0, 255)
+        if in_palette is not None:
+            mask = in_palette[_pack_colors(frame)]
+            dithered_frame[mask] = frame[mask]
+    return dithered
+
+
+def _pack_colors(colors: onp.ndarray) -> onp.ndarray:
+    """Returns the 24-bit integer for each RGB color in the uint8 `colors`."""
+    colors = colors.astype(onp.uint32)
+    packed: onp.ndarray = (
+        (colors[..., 0] << 16) | (colors[..., 1] << 8) | colors[..., 2]
+    )
+    return packed
+
+
+@functools.lru_cache(maxsize=None)
+def _blue_noise_tile(size: int = 64, sigma: float = 1.5) -> onp.ndarray:
+    """Returns a tileable blue noise threshold map, with values in `[0, 1)`.
+
+    The map is generated with the void-and-cluster method, in which pixels are
+    ranked by repeatedly selecting the tightest cluster or largest void of a
+    binary pattern, as measured by a periodic Gaussian filter.
+
+    Args:
+        size: The size of the square map.
+        sigma: The standard deviation of the Gaussian filter, in pixels.
+
+    Returns:
+        The `(size, size)` threshold map.
+    """
+    distance = onp.minimum(onp.arange(size), size - onp.arange(size))
+    kernel = onp.exp(
+        -(distance[:, None] ** 2 + distance[None, :] ** 2) / sigma**2 / 2
+    )
+
+    def _toggle(index: int, value: bool) -> None:
+        y, x = divmod(index, size)
+        pattern.flat[index] = value
+        sign = 1 if value else -1
+        energy[...] += sign * onp.roll(kernel, (y, x), axis=(0, 1))
+
+    def _tightest_cluster() -> int:
+        return int(onp.argmax(onp.where(pattern, energy, -onp.inf)))
+
+    def _largest_void() -> int:
+        return int(onp.argmin(onp.where(pattern, onp.inf, energy)))
+
+    # Generate an initial pattern with uniformly distributed points.
+    pattern = onp.random.default_rng(0).random((size, size)) < 0.1
+    energy = onp.real(onp.fft.ifft2(onp.fft.fft2(pattern) * onp.fft.fft2(kernel)))
+    while True:
+        cluster = _tightest_cluster()
+        _toggle(cluster, False)
+        void = _largest_void()
+        _toggle(void, True)
+        if void == cluster:
+            break
+
+    ranks = onp.zeros(size * size)
+    initial_pattern, initial_energy = pattern.copy(), energy.copy()
+    num_points = int(onp.sum(pattern))
+    for rank in range(num_points - 1, -1, -1):
+        cluster = _tightest_cluster()
+        _toggle(cluster, False)
+        ranks[cluster] = rank
+    pattern[...], energy[...] = initial_pattern, initial_energy
+    for rank in range(num_points, size * size):
+        void = _largest_void()
+        _toggle(void, True)
+        ranks[void] = rank
+    return ((ranks + 0.5) / size**2).reshape(size, size)
+
+
+def _remap_frames(
+    frames: onp.ndarray,
+    palette_image: Image.Image,
+    cache: Optional[onp.ndarray] = None,
+) -> onp.ndarray:
+    """Maps each pixel in `frames` to the nearest color in the palette.
+
+    The optional numba kernel is used if available; otherwise frames are
+    remapped with Pillow.
+
+    Args:
+        frames: The frames to be remapped.
+        palette_image: The paletted image whose palette is used.
+        cache: Optional cache from `_new_remap_cache`, to be reused by calls with
+            the same palette. If `None`, a new cache is used.
+
+    Returns:
+        The `(num_frames, height, width)` array of palette indices.
+    """
+    quantized_frames = onp.empty(frames.shape[:3], dtype=onp.uint8)
+    try:
+        from gifcm import _quantize_numba
+    except ImportError:
+        _remap_frames_pil(frames, palette_image, quantized_frames)
+        return quantized_frames
+
+    palette = onp.asarray(palette_image.getpalette(), dtype=onp.uint8).reshape(-1, 3)
+    if cache is None:
+        cache = _quantize_numba.new_cache()
+    for frame, out in zip(frames, quantized_frames):
+        _quantize_numba.remap(frame, palette, cache, out)
+    return quantized_frames
+
+
+def _new_remap_cache() -> Optional[onp.ndarray]:
+    """Returns a cache for `_remap_frames`, or `None` if numba is not installed."""
+    try:
+        from gifcm import _quantize_numba
+    except ImportError:
+        return None
+    return _quantize_numba.new_cache()
+
+
+def _remap_frames_pil(
+    frames: onp.ndarray,
+    palette_image: Image.Image,
+    out: onp.ndarray,
+) -> None:
+    """Maps each pixel in `frames` to the nearest palette color using Pillow."""
+
+    def _remap(i: int) -> None:
+        image = Image.fromarray(frames[i])
+        out[i] = onp.asarray(image.quantize(palette=palette_image, dither=0))
+
+    if len(frames) == 1:
+        _remap(0)
+        return
+    # Remapping is done by Pillow's C code, which releases the GIL.
+    with futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(_remap, range(len(frames))))
+
+
+def _sample_pixels(
+    frames: onp.ndarray,
+    num_samples: int = _PALETTE_SAMPLE_SIZE,
+) -> onp.ndarray:
+    """Returns an image made up of at most `num_samples` pixels from `frames`.
+
+    The palette depends only on the distribution of colors, and so it can be
+    computed from a subset of the pixels rather than the full frames. Pixels are
+    sampled at random with a fixed seed, since a regular stride can alias with
+    the frame width and miss thin vertical features entirely.
+
+    Args:
+        frames: The rank-4 array of frames from which pixels are sampled.
+        num_samples: The maximum number of pixels to be sampled.
+
+    Returns:
+        The sampled pixels, as a rank-3 array with width `1`.
+    """
+    pixels = frames.reshape(-1, frames.shape[-1])
+    if len(pixels) <= num_samples:
+        return pixels[:, onp.newaxis, :]
+    rng = onp.random.default_rng(0)
+    indices = onp.sort(rng.integers(len(pixels), size=num_samples))
+    return pixels[indices, onp.newaxis, :]
+
+
+def _compute_palette_image(image: onp.ndarray, backend: str) -> Image.Image:
+    """Returns a paletted image whose palette has at most 256 colors."""
+    if backend == "imagequant":
+        palette_image = Image.new("P", (1, 1))
+        palette_image.putpalette(_quantize_imagequant(image))
+        return palette_image
+    return Image.fromarray(image).quantize(colors=256, dither=0)
+
+
+def _quantize_imagequant(image: onp.ndarray) -> List[int]:
+    """Computes a palette with at most 256 colors for `image` using libimagequant.
+
+    Args:
+        image: The rank-3 image for which the palette is computed.
+
+    Returns:
+        The RGB palette.
+    """
+    try:
+        import imagequant
+    except ImportError as e:
+        raise ImportError(
+            "The `imagequant` backend requires the `imagequant` package, which can "
+            "be installed with `pip install gifcm[imagequant]`."
+        ) from e
+    height, width = image.shape[:2]
+    rgba = Image.fromarray(image).convert("RGBA").tobytes()
+    _, rgba_palette = imagequant.quantize_raw_rgba_bytes(
+        rgba, width, height, dithering_level=0.0, max_colors=256
+    )
+    return [c for i, c in enumerate(rgba_palette) if i % 4 != 3]
@@ -0,0 +1,8 @@
+"""Test configuration for `gifcm`."""
+
+import os
+
+# With numba's TBB threading layer, the test process hangs at exit once the numba
+# remap kernel has run and a video has been saved with ffmpeg. The workqueue layer
+# is always available, and is used unless a layer is configured explicitly.
+os.environ.setdefault("NUMBA_THREADING_LAYER", "workqueue")
@@ -2,25 +2,34 @@
 
 import tempfile
 import unittest
+from unittest import mock
 
 import matplotlib.pyplot as plt
 import numpy as onp
 import parameterized
+from matplotlib.backends import backend_svg
 from PIL import Image
 
 import gifcm
 from gifcm import animated_figure
 
 
+def _solid_color_animation(values, **kwargs):
+    """Returns an animation whose frames are solid gray with the given `values`."""
+    fig = plt.figure(figsize=(2, 2))
+    anim = gifcm.AnimatedFigure(fig, **kwargs)
+    for value in values:
+        with anim.frame():
+            plt.imshow(onp.full((5, 5, 3), value, dtype=onp.uint8))
+            plt.subplots_adjust(left=0, bottom=0, right=1, top=1)
+    plt.close(fig)
+    return anim
+
+
 class TestGifCreation(unittest.TestCase):
     @parameterized.parameterized.expand([[1], [2], [10]])
     def test_figure_imshow(self, num_frames):
-        fig = plt.figure(figsize=(2, 2))
-        anim = gifcm.AnimatedFigure(fig)
-        for frame_idx in range(num_frames):
-            with anim.frame():
-                plt.imshow(onp.full((5, 5, 3), frame_idx * 25, dtype=onp.uint8))
-                plt.subplots_adjust(left=0, bottom=0, right=1, top=1)
+        anim = _solid_color_animation([i * 25 for i in range(num_frames)])
 
         with tempfile.TemporaryDirectory() as tempdir:
             fname = "/".join([tempdir, "anim.gif"])
@@ -38,6 +47,7 @@ class TestGifCreation(unittest.TestCase):
                 plt.xlim([0, num_frames])
                 plt.ylim([0, num_frames])
                 plt.subplots_adjust(left=0, bottom=0, right=1, top=1)
+        plt.close(fig)
 
         with tempfile.TemporaryDirectory() as tempdir:
             fname = "/".join([tempdir, "anim.gif"])
@@ -45,24 +55,466 @@ class TestGifCreation(unittest.TestCase):
             im = Image.open(fname)
         self.assertEqual(im.n_frames, num_frames)
 
+    @parameterized.parameterized.expand([[0], [2], [5]])
+    def test_frames_are_contiguous(self, num_reserved):
+        fig = plt.figure(figsize=(2, 2))
+        anim = gifcm.AnimatedFigure(fig)
+        anim.reserve(num_reserved)
+        for frame_idx in range(5):
+            with anim.frame():
+                plt.imshow(onp.full((5, 5, 3), frame_idx * 25, dtype=onp.uint8))
+                plt.subplots_adjust(left=0, bottom=0, right=1, top=1)
+        plt.close(fig)
+        self.assertEqual(anim.frames.shape, (5, 200, 200, 3))
+        self.assertTrue(anim.frames.flags["C_CONTIGUOUS"])
+        onp.testing.assert_array_equal(
+            anim.frames[:, 100, 100, 0], [0, 25, 50, 75, 100]
+        )
+
+    def test_frames_are_stored_in_chunks(self):
+        # Each chunk holds two of the 200x200 RGB frames.
+        with mock.patch.object(animated_figure, "_CHUNK_BYTES", 2 * 200 * 200 * 3):
+            anim = _solid_color_animation([i * 25 for i in range(5)])
+        self.assertEqual([len(chunk) for chunk in anim._chunks], [2, 2, 2])
+        onp.testing.assert_array_equal(
+            anim.frames[:, 100, 100, 0], [0, 25, 50, 75, 100]
+        )
+        self.assertEqual(len(anim._chunks), 1)
+        self.assertTrue(anim.frames.flags["C_CONTIGUOUS"])
+
+    @parameterized.parameterized.expand([[False], [True]])
+    def test_identical_frames_are_merged(self, stream):
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = "/".join([tempdir, "anim.gif"])
+            anim = _solid_color_animation(
+                [0, 0, 0, 51, 102, 102], gif_path=fname if stream else None
+            )
+            if stream:
+                anim.close()
+            else:
+                self.assertEqual(len(anim.frames), 3)
+                anim.save_gif(fname)
+
+            im = Image.open(fname)
+            self.assertEqual(im.n_frames, 3)
+            durations = []
+            for frame_idx in range(3):
+                im.seek(frame_idx)
+                durations.append(im.info["duration"])
+        self.assertEqual(durations, [300, 100, 200])
+
+    @parameterized.parameterized.expand([[False], [True]])
+    def test_rejected_frame_is_not_counted(self, stream):
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = "/".join([tempdir, "anim.gif"])
+            fig = plt.figure(figsize=(2, 2))
+            anim = gifcm.AnimatedFigure(fig, gif_path=fname if stream else None)
+            with anim.frame():
+                pass
+            fig.set_size_inches(3, 2)
+            with self.assertRaisesRegex(ValueError, "same shape"), anim.frame():
+                pass
+            fig.set_size_inches(2, 2)
+            with anim.frame():
+                plt.plot(0, 0, "o")
+            plt.close(fig)
+            if stream:
+                anim.close()
+            else:
+                self.assertEqual(len(anim.frames), 2)
+                anim.save_gif(fname)
+            self.assertEqual(anim._frame_counts, [1, 1])
+            self.assertEqual(Image.open(fname).n_frames, 2)
+
+    def test_blit_matches_full_redraw(self):
+        xs = onp.linspace(0, 1, 20)
+
+        def _make_figure():
+            fig, ax = plt.subplots(figsize=(2, 2))
+            ax.set_xlim(0, 1)
+            ax.set_ylim(-1, 1)
+            (line,) = ax.plot([], [], animated=True)
+            return fig, ax, line
+
+        fig, ax, line = _make_figure()
+        blit_anim = gifcm.AnimatedFigure(fig, blit=True)
+        for frame_idx in range(3):
+            with blit_anim.frame():
+                line.set_data(xs, onp.sin(xs * 6 + frame_idx))
+                ax.draw_artist(line)
+        plt.close(fig)
+
+        fig, ax, line = _make_figure()
+        line.set_animated(False)
+        anim = gifcm.AnimatedFigure(fig)
+        for frame_idx in range(3):
+            with anim.frame(clear_figure=False):
+                line.set_data(xs, onp.sin(xs * 6 + frame_idx))
+        plt.close(fig)
+
+        # The blitted line is drawn over the axes spines, and so a small number of
+        # pixels differ from the full redraw.
+        self.assertEqual(len(blit_anim.frames), 3)
+        self.assertLess(onp.mean(blit_anim.frames != anim.frames), 0.01)
+
+
+class StreamingTest(unittest.TestCase):
+    @parameterized.parameterized.expand([["adaptive"], ["fixed"]])
+    def test_stream_gif(self, palette_mode):
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = "/".join([tempdir, "anim.gif"])
+            fig = plt.figure(figsize=(2, 2))
+            anim = gifcm.AnimatedFigure(
+                fig, gif_path=fname, duration=50, palette_mode=palette_mode
+            )
+            for frame_idx in range(4):
+                with anim.frame():
+                    # The first row contains all colors, so that they are included
+                    # in a palette computed from the first frame.
+                    image = onp.full((5, 5, 3), frame_idx * 51, dtype=onp.uint8)
+                    image[0, :4, :] = onp.arange(0, 204, 51)[:, onp.newaxis]
+                    plt.imshow(image)
+                    plt.subplots_adjust(left=0, bottom=0, right=1, top=1)
+            plt.close(fig)
+            anim.close()
+            self.assertEqual(len(anim.frames), 0)
+
+            im = Image.open(fname)
+            self.assertEqual(im.n_frames, 4)
+            self.assertEqual(im.info["duration"], 50)
+            for frame_idx in range(4):
+                im.seek(frame_idx)
+                pixel = im.convert("RGB").getpixel((100, 100))
+                onp.testing.assert_allclose(pixel, (frame_idx * 51,) * 3, atol=2)
+
+    def test_save_gif_raises_when_streaming(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = "/".join([tempdir, "anim.gif"])
+            fig = plt.figure()
+            anim = gifcm.AnimatedFigure(fig, gif_path=fname)
+            with anim.frame():
+                plt.plot(0, 0, "o")
+            plt.close(fig)
+            with self.assertRaisesRegex(ValueError, "use `close`"):
+                anim.save_gif(fname)
+            anim.close()
+
+    def test_stream_context_manager(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = "/".join([tempdir, "anim.gif"])
+            with _solid_color_animation([0, 51], gif_path=fname) as anim:
+                pass
+            anim.close()
+            self.assertEqual(Image.open(fname).n_frames, 2)
+
+    def test_stream_file_is_closed_on_error(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = "/".join([tempdir, "anim.gif"])
+            fig = plt.figure()
+            anim = gifcm.AnimatedFigure(fig, gif_path=fname)
+            with self.assertRaisesRegex(RuntimeError, "capture failed"), anim:
+                raise RuntimeError("capture failed")
+            plt.close(fig)
+            self.assertTrue(anim._gif_stream._file.closed)
+
+    @parameterized.parameterized.expand(
+        [
+            [{"palette_mode": "fixed"}, "require `gif_path`"],
+            [{"duration": 50, "loop": 1}, "require `gif_path`"],
+            [{"gif_path": "anim.gif", "palette_mode": "bogus"}, "`palette_mode`"],
+            [{"palette_mode": "bogus"}, "`palette_mode`"],
+            [{"gif_path": "anim.gif", "duration": -5}, "`duration`"],
+            [{"gif_path": "anim.gif", "loop": -1}, "`loop`"],
+        ]
+    )
+    def test_invalid_stream_options(self, kwargs, message):
+        fig = plt.figure()
+        with self.assertRaisesRegex(ValueError, message):
+            gifcm.AnimatedFigure(fig, **kwargs)
+        plt.close(fig)
+
+    def test_stream_raises_on_shape_change(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = "/".join([tempdir, "anim.gif"])
+            fig = plt.figure(figsize=(2, 2))
+            anim = gifcm.AnimatedFigure(fig, gif_path=fname)
+            with anim.frame():
+                plt.plot(0, 0, "o")
+            fig.set_size_inches(3, 2)
+            with self.assertRaisesRegex(ValueError, "same shape"), anim.frame():
+                plt.plot(1, 1, "o")
+            plt.close(fig)
+            anim.close()
+            self.assertEqual(Image.open(fname).n_frames, 1)
+
+
+class VideoTest(unittest.TestCase):
+    @parameterized.parameterized.expand(
+        [[(2, 2), (200, 200, 3)], [(2.01, 1.99), (200, 202, 3)]]
+    )
+    def test_save_video(self, figsize, video_frame_shape):
+        try:
+            import imageio
+            import imageio_ffmpeg  # noqa: F401
+        except ImportError:
+            self.skipTest("`imageio` and `imageio-ffmpeg` are not installed.")
+        fig = plt.figure(figsize=figsize)
+        anim = gifcm.AnimatedFigure(fig)
+        for value in [0, 51, 51, 102]:
+            with anim.frame():
+                plt.imshow(onp.full((5, 5, 3), value, dtype=onp.uint8))
+                plt.subplots_adjust(left=0, bottom=0, right=1, top=1)
+        plt.close(fig)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = "/".join([tempdir, "anim.mp4"])
+            anim.save_video(fname, fps=5)
+            with imageio.get_reader(fname) as reader:
+                video_frames = [frame for frame in reader]
+        self.assertEqual(len(video_frames), 4)
+        for frame in video_frames:
+            self.assertEqual(frame.shape, video_frame_shape)
+
 
 class SaveFigureTest(unittest.TestCase):
+    def _capture_frame(self, fig, image=None):
+        anim = gifcm.AnimatedFigure(fig)
+        with anim.frame(clear_figure=False):
+            if image is not None:
+                plt.imshow(*image)
+        plt.close(fig)
+        return anim.frames[0]
+
     def test_grayscale_image(self):
-        fig = plt.figure()
-        plt.imshow(onp.arange(100).reshape(10, 10), cmap="gray")
-        array = animated_figure._save_figure_to_array(fig)
+        image = (onp.arange(100).reshape(10, 10), "gray")
+        array = self._capture_frame(plt.figure(), image)
         self.assertEqual(array.ndim, 3)
 
     def test_rgb_image(self):
-        fig = plt.figure()
-        plt.imshow(onp.arange(100).reshape(10, 10), cmap="magma")
-        array = animated_figure._save_figure_to_array(fig)
+        image = (onp.arange(100).reshape(10, 10), "magma")
+        array = self._capture_frame(plt.figure(), image)
         self.assertEqual(array.ndim, 3)
 
     def test_rgba_image(self):
-        fig = plt.figure()
         im = onp.linspace(0, 255, 10 * 10 * 4)
         im = im.astype(int).reshape((10, 10, 4))
-        plt.imshow(im)
-        array = animated_figure._save_figure_to_array(fig)
+        array = self._capture_frame(plt.figure(), (im,))
         self.assertEqual(array.ndim, 3)
+
+    def test_array_is_row_major(self):
+        fig = plt.figure(figsize=(3, 2), dpi=50)
+        width, height = fig.canvas.get_width_height()
+        array = self._capture_frame(fig)
+        self.assertEqual(array.shape, (height, width, 3))
+        self.assertTrue(array.flags["C_CONTIGUOUS"])
+
+    def test_tight_layout(self):
+        arrays = []
+        for tight_layout in [False, True]:
+            fig = plt.figure(figsize=(2, 2))
+            anim = gifcm.AnimatedFigure(fig, tight_layout=tight_layout)
+            with anim.frame():
+                plt.plot([0, 1], [0, 1])
+            plt.close(fig)
+            arrays.append(anim.frames[0])
+        self.assertEqual(arrays[0].shape, arrays[1].shape)
+        self.assertFalse(onp.array_equal(arrays[0], arrays[1]))
+
+    @parameterized.parameterized.expand([[False], [True]])
+    def test_non_agg_canvas(self, blit):
+        fig = plt.figure(figsize=(2, 2))
+        backend_svg.FigureCanvasSVG(fig)
+        anim = gifcm.AnimatedFigure(fig, blit=blit)
+        with anim.frame(clear_figure=False):
+            plt.plot([0, 1], [0, 1])
+        self.assertEqual(anim.frames.shape, (1, 200, 200, 3))
+        plt.close(fig)
+
+
+class BackendTest(unittest.TestCase):
+    @parameterized.parameterized.expand([["pil"], ["imagequant"]])
+    def test_backend(self, backend):
+        if backend == "imagequant":
+            try:
+                import imagequant  # noqa: F401
+            except ImportError:
+                self.skipTest("`imagequant` is not installed.")
+        anim = _solid_color_animation([0, 25, 50])
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = "/".join([tempdir, "anim.gif"])
+            anim.save_gif(fname, backend=backend)
+            im = Image.open(fname)
+        self.assertEqual(im.n_frames, 3)
+
+    @parameterized.parameterized.expand(
+        [
+            ["adaptive", "none"],
+            ["adaptive", "bluenoise"],
+            ["fixed", "none"],
+            ["fixed", "bluenoise"],
+        ]
+    )
+    def test_palette_mode_and_dither(self, palette_mode, dither):
+        fig = plt.figure(figsize=(2, 2))
+        anim = gifcm.AnimatedFigure(fig)
+        for frame_idx in range(3):
+            with anim.frame():
+                plt.plot(frame_idx, frame_idx, "o")
+        plt.close(fig)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = "/".join([tempdir, "anim.gif"])
+            anim.save_gif(fname, palette_mode=palette_mode, dither=dither)
+            im = Image.open(fname)
+        self.assertEqual(im.n_frames, 3)
+
+    def test_user_palette(self):
+        fig = plt.figure(figsize=(2, 2))
+        anim = gifcm.AnimatedFigure(fig)
+        for frame_idx in range(3):
+            with anim.frame():
+                plt.imshow(onp.full((5, 5), frame_idx), cmap="viridis", vmin=0, vmax=2)
+                plt.subplots_adjust(left=0, bottom=0, right=1, top=1)
+        plt.close(fig)
+
+        colors = plt.get_cmap("viridis")(onp.linspace(0, 1, 256))[:, :3]
+        palette = Image.new("P", (1, 1))
+        palette.putpalette(list(onp.round(colors * 255).astype(int).flatten()))
+        with tempfile.TemporaryDirectory() as tempdir:
+            fname = "/".join([tempdir, "anim.gif"])
+            anim.save_gif(fname, palette=palette)
+            im = Image.open(fname)
+            self.assertEqual(im.n_frames, 3)
+            im.seek(2)
+            pixel = im.convert("RGB").getpixel((100, 100))
+        onp.testing.assert_allclose(pixel, onp.round(colors[-1] * 255), atol=1)
+
+    def test_invalid_backend(self):
+        fig = plt.figure(figsize=(2, 2))
+        anim = gifcm.AnimatedFigure(fig)
+        with anim.frame():
+            plt.plot(0, 0, "o")
+        plt.close(fig)
+        with self.assertRaisesRegex(ValueError, "`backend` must be one of"):
+            anim.save_gif("anim.gif", backend="invalid")
+
+    @parameterized.parameterized.expand(
+        [
+            [{"palette": Image.new("RGB", (1, 1))}, "mode 'P'"],
+            [{"palette": Image.new("P", (1, 1)), "palette_mode": "fixed"}, "fixed"],
+            [{"palette": Image.new("P", (1, 1)), "backend": "imagequant"}, "backend"],
+            [{"palette_mode": "fixed", "backend": "imagequant"}, "backend"],
+        ]
+    )
+    def test_invalid_palette_options(self, kwargs, message):
+        anim = _solid_color_animation([0])
+        with self.assertRaisesRegex(ValueError, message):
+            anim.save_gif("anim.gif", **kwargs)
+
+
+class QuantizeTest(unittest.TestCase):
+    def test_sample_pixels(self):
+        frames = onp.zeros((10, 100, 200, 3), dtype=onp.uint8)
+        sample = animated_figure._sample_pixels(frames, num_samples=1000)
+        self.assertEqual(sample.shape, (1000, 1, 3))
+
+    def test_sample_pixels_includes_thin_features(self):
+        # A strided sample of these frames would have a stride of 8, and would
+        # skip the line entirely.
+        frames = onp.full((10, 400, 400, 3), 255, dtype=onp.uint8)
+        frames[:, :, 3:6] = [255, 0, 0]
+        sample = animated_figure._sample_pixels(frames)
+        self.assertTrue(onp.any(onp.all(sample == [255, 0, 0], axis=-1)))
+        quantized, palette = animated_figure._quantize_frames(frames)
+        palette = onp.asarray(palette).reshape(-1, 3)
+        onp.testing.assert_array_equal(palette[quantized[0, 0, 3:6]], [[255, 0, 0]] * 3)
+
+    def test_quantized_colors_match_frames(self):
+        frames = onp.full((3, 50, 40, 3), 255, dtype=onp.uint8)
+        for i, frame in enumerate(frames):
+            frame[:20] = i * 60
+        quantized, palette = animated_figure._quantize_frames(frames)
+        palette = onp.asarray(palette).reshape(-1, 3)
+        for frame, quantized_frame in zip(frames, quantized):
+            onp.testing.assert_array_equal(palette[quantized_frame], frame)
+
+    def test_numba_remap_finds_nearest_color(self):
+        try:
+            from gifcm import _quantize_numba
+        except ImportError:
+            self.skipTest("`numba` is not installed.")
+        palette = onp.asarray([[0, 0, 0], [255, 255, 255], [200, 0, 0]], onp.uint8)
+        frame = onp.asarray([[[10, 10, 10], [250, 240, 255], [180, 20, 10]]], onp.uint8)
+        out = onp.empty(frame.shape[:2], dtype=onp.uint8)
+        _quantize_numba.remap(frame, palette, _quantize_numba.new_cache(), out)
+        onp.testing.assert_array_equal(out, [[0, 1, 2]])
+
+    def test_remap_cache_is_reused(self):
+        cache = animated_figure._new_remap_cache()
+        if cache is None:
+            self.skipTest("`numba` is not installed.")
+        frames = onp.zeros((1, 4, 4, 3), dtype=onp.uint8)
+        palette_image = Image.new("P", (1, 1))
+        palette_image.putpalette([255, 255, 255, 0, 0, 0])
+        quantized = animated_figure._remap_frames(frames, palette_image, cache=cache)
+        onp.testing.assert_array_equal(quantized, 1)
+        self.assertEqual(cache[0], 1)
+
+    def test_fixed_palette(self):
+        frames = onp.full((3, 50, 40, 3), 255, dtype=onp.uint8)
+        for i, frame in enumerate(frames):
+            frame[:20] = i * 51
+            frame[20:30, :, 1] = 60
+        quantized, palette = animated_figure._quantize_frames_fixed(frames)
+        self.assertEqual(quantized.shape, (3, 50, 40))
+        palette = onp.asarray(palette).reshape(-1, 3)
+        expected = frames.copy()
+        expected[:, 20:30, :, 1] = 51
+        onp.testing.assert_array_equal(palette[quantized], expected)
+
+    def test_invalid_frame_rank(self):
+        frames = onp.zeros((2, 10, 10), dtype=onp.uint8)
+        with self.assertRaisesRegex(ValueError, "Frames must be rank-3"):
+            animated_figure._save_frames_to_gif(frames, "anim.gif", 100, 0)
+
+    def test_blue_noise_tile_is_permutation(self):
+        tile = animated_figure._blue_noise_tile()
+        self.assertEqual(tile.shape, (64, 64))
+        self.assertEqual(len(onp.unique(tile)), 64 * 64)
+        self.assertTrue(((tile > 0) & (tile < 1)).all())
+
+    @parameterized.parameterized.expand([["adaptive"], ["fixed"]])
+    def test_bluenoise_dither_preserves_flat_palette_colors(self, palette_mode):
+        frames = onp.full((2, 128, 128, 3), 255, dtype=onp.uint8)
+        frames[:, :64] = onp.linspace(0, 255, 128).astype(onp.uint8)[:, onp.newaxis]
+        if palette_mode == "fixed":
+            dithered = animated_figure._dither_bluenoise(
+                frames, amplitude=51, palette=animated_figure._CUBE_PALETTE
+            )
+            quantized, palette = animated_figure._quantize_frames_fixed(dithered)
+        else:
+            quantized, palette = animated_figure._quantize_frames(
+                frames, dither="bluenoise"
+            )
+        palette = onp.asarray(palette).reshape(-1, 3)
+        onp.testing.assert_array_equal(palette[quantized[:, 64:]], 255)
+
+    def test_bluenoise_dither_preserves_mean_color(self):
+        frames = onp.full((2, 128, 128, 3), 100, dtype=onp.uint8)
+        dithered = animated_figure._dither_bluenoise(frames, amplitude=51)
+        quantized, palette = animated_figure._quantize_frames_fixed(dithered)
+        palette = onp.asarray(palette).reshape(-1, 3)
+        self.assertAlmostEqual(palette[quantized].mean(), 100, delta=1)
+
+    def test_pil_remap_matches_palette_colors(self):
+        frames = onp.full((3, 50, 40, 3), 255, dtype=onp.uint8)
+        for i, frame in enumerate(frames):
+            frame[:20] = i * 60
+        palette_image = animated_figure._compute_palette_image(
+            animated_figure._sample_pixels(frames), backend="pil"
+        )
+        quantized = onp.empty(frames.shape[:3], dtype=onp.uint8)
+        animated_figure._remap_frames_pil(frames, palette_image, quantized)
+        palette = onp.asarray(palette_image.getpalette()).reshape(-1, 3)
+        onp.testing.assert_array_equal(palette[quantized], frames)